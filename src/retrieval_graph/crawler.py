@@ -1,24 +1,84 @@
+import asyncio
+import functools
+import gzip
+import itertools
 import os
-import uuid
-from urllib.parse import urldefrag, urljoin, urlparse
+import time
+from collections import defaultdict
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
 
+import httpx
+import lxml.html
+import tldextract
 from playwright.async_api import async_playwright
 
+# Query parameters that never change page content (tracking/session/signature
+# noise); stripping them before dedup avoids re-crawling the same page.
+_DENYLISTED_QUERY_PARAMS = frozenset({"gclid", "fbclid", "msclkid", "sessionid", "phpsessid"})
+_DENYLISTED_QUERY_PREFIXES = ("utm_", "x-amz-")
+
+# Resource types the crawler never needs: only the HTML is saved, so
+# downloading images/fonts/media/styles just slows every page load down.
+_BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+
+# Politeness knobs: at most this many in-flight fetches per host, spaced at
+# least this many seconds apart, with bounded retries on throttling statuses.
+_PER_HOST_CONCURRENCY = 2
+_PER_HOST_MIN_INTERVAL = 0.25
+_THROTTLE_STATUSES = (429, 503)
+_MAX_RETRIES = 3
+_BACKOFF_BASE = 1.0
+
+# Upper bound on crawled_pages metadata entries, so a runaway crawl cannot
+# grow the tracking list without limit.
+_MAX_TRACKED_PAGES = 100_000
+
+# Maximum raw pages buffered ahead of the writer task; beyond this, crawl
+# workers block on the queue so a slow disk cannot balloon memory.
+_WRITE_QUEUE_MAXSIZE = 64
+
+# Pages with this many script tags (or more) are assumed to need JavaScript
+# rendering; anything below it is served from the plain-HTTP fast path.
+_MAX_STATIC_SCRIPT_TAGS = 10
+
+
+@functools.lru_cache(maxsize=200_000)
+def _registrable_domain(host):
+    """Return the registrable domain (e.g. "example.co.uk") of a host."""
+    parts = tldextract.extract(host)
+    return f"{parts.domain}.{parts.suffix}" if parts.suffix else parts.domain
+
+
+async def _block_heavy_resources(route):
+    """Abort requests for resource types the crawler does not consume."""
+    if route.request.resource_type in _BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
+
 class WebCrawler:
     """
     A web crawler that recursively crawls a set of starter URLs up to a specified number of hops,
     saves the crawled page content locally, and ensures only allowed domains are visited.
 
+    Pages are fetched by a pool of concurrent workers sharing a single browser context,
+    so network waits for different URLs overlap instead of serializing.
+
     Attributes:
         starter_urls (list): The initial list of URLs to start crawling from.
         hops (int): The maximum number of link hops to follow from the starter URLs.
         allowed_domains (list): List of allowed domain suffixes for crawling.
         storage_folder (str): Path to the folder where crawled pages will be saved.
+        concurrency (int): Number of concurrent page-fetching workers.
+        browser: An optional shared Playwright browser to crawl with.
+        context: An optional shared Playwright browser context to crawl with.
         visited_urls (set): A set to track visited URLs and prevent duplicate crawling.
         crawled_pages (list): A list of metadata for all successfully crawled pages.
     """
 
-    def __init__(self, starter_urls, hops, allowed_domains, storage_folder):
+    def __init__(self, starter_urls, hops, allowed_domains, storage_folder,
+                 concurrency=10, browser=None, context=None,
+                 on_page=None, persist=True):
         """
         Initialize the WebCrawler instance with given parameters.
 
@@ -27,13 +87,44 @@ class WebCrawler:
             hops (int): Maximum number of link hops to follow.
             allowed_domains (list): List of domain suffixes that the crawler can visit.
             storage_folder (str): Directory to save the crawled page content.
+            concurrency (int): Number of concurrent page-fetching workers.
+            browser: Optional Playwright browser shared across crawls; a context is
+                created (and closed) per crawl. If omitted, a browser is launched.
+            context: Optional Playwright browser context shared across crawls; takes
+                precedence over `browser` and is left open for the caller to close.
+            on_page: Optional async callback awaited as `on_page(content, url)` for
+                each crawled page, so callers can consume pages straight from memory.
+            persist (bool): Whether to also write crawled pages to the storage
+                folder. Set False when `on_page` makes the disk copy redundant.
         """
         self.starter_urls = starter_urls
         self.hops = hops
         self.allowed_domains = allowed_domains
         self.storage_folder = storage_folder
+        self.concurrency = concurrency
+        self.browser = browser
+        self.context = context
+        self.on_page = on_page
+        self.persist = persist
         self.visited_urls = set()
         self.crawled_pages = []
+        self._visited_lock = asyncio.Lock()
+        # Registrable domains of the allowed set, for O(1) membership checks
+        self._allowed_registrable = frozenset(
+            _registrable_domain(domain) for domain in allowed_domains
+        )
+        # Write queue and HTTP client; created once a crawl starts
+        self._write_q = None
+        self._http_client = None
+        # Monotonic sequence for file names; the storage folder is the
+        # per-tenant namespace, so cryptographic uniqueness is unnecessary
+        self._seq = itertools.count(1)
+        # Per-host politeness state: fetch slots, earliest next-fetch time,
+        # and retry counts for throttled URLs
+        self._host_slots = defaultdict(lambda: asyncio.Semaphore(_PER_HOST_CONCURRENCY))
+        self._host_next_fetch = defaultdict(float)
+        self._retry_counts = {}
+        self._pages_cap_warned = False
 
         # Ensure the storage folder exists
         os.makedirs(self.storage_folder, exist_ok=True)
@@ -42,121 +133,460 @@ class WebCrawler:
         """
         Check if a given URL belongs to an allowed domain.
 
+        The comparison is on registrable domains, so "sub.example.com" is
+        allowed for "example.com" while "evilexample.com" is not — a suffix
+        match would accept the latter.
+
         Args:
             url (str): The URL to check.
 
         Returns:
             bool: True if the URL is allowed, False otherwise.
         """
-        domain = urlparse(url).netloc
-        return any(domain.endswith(allowed) for allowed in self.allowed_domains)
+        netloc = self._normalize_url_cached(url)[1]
+        return _registrable_domain(netloc) in self._allowed_registrable
 
-    def normalize_url(self, url):
+    @staticmethod
+    @functools.lru_cache(maxsize=200_000)
+    def _normalize_url_cached(url):
         """
-        Normalize a URL by removing fragments and adjusting trailing slashes.
+        Normalize a URL (pure, memoized part of `normalize_url`).
+
+        A single urlsplit feeds both the normalization and the netloc that
+        `is_allowed` checks, so each URL is parsed exactly once.
 
         Args:
             url (str): The URL to normalize.
 
         Returns:
-            str: The normalized URL.
+            tuple: The normalized URL and its lowercased netloc.
         """
-        # Remove fragment (e.g., "#section")
-        url, _ = urldefrag(url)
+        scheme, netloc, path, query, _fragment = urlsplit(url)
+
+        # Lowercase the case-insensitive parts and drop the fragment
+        scheme = scheme.lower()
+        netloc = netloc.lower()
+
+        # Drop tracking/signature query params and sort the rest so that
+        # equivalent URLs collapse to one visited-set entry
+        if query:
+            kept = sorted(
+                (key, value)
+                for key, value in parse_qsl(query, keep_blank_values=True)
+                if key.lower() not in _DENYLISTED_QUERY_PARAMS
+                and not key.lower().startswith(_DENYLISTED_QUERY_PREFIXES)
+            )
+            query = urlencode(kept)
+
+        # Ensure trailing slash consistency: "/" for root URLs, none elsewhere
+        path = path.rstrip('/') or '/'
+        return urlunsplit((scheme, netloc, path, query, '')), netloc
 
-        # Ensure trailing slash consistency for root URLs
-        if url.count('/') == 2 and not url.endswith('/'):
-            url += '/'
-        else:
-            # Remove trailing slash for other cases
-            url = url.rstrip('/')
+    def normalize_url(self, url):
+        """
+        Normalize a URL by removing fragments and tracking query parameters,
+        lowercasing the scheme/netloc, and adjusting trailing slashes.
+
+        Large sites link to the same URLs many times; the underlying parse is
+        memoized so repeats are a cache hit instead of a re-parse.
+
+        Args:
+            url (str): The URL to normalize.
 
-        return url
+        Returns:
+            str: The normalized URL.
+        """
+        return self._normalize_url_cached(url)[0]
 
-    def save_page_content(self, content, url):
+    async def save_page_content(self, content, url):
         """
-        Save the crawled page content to a local file and track its metadata.
+        Hand a crawled page to the `on_page` callback and/or the writer task.
+
+        Disk writes happen off the event loop so Playwright workers never
+        stall on file IO, and are skipped entirely when `persist` is False.
+        The write queue is bounded: if the disk falls behind the crawl, the
+        put blocks and workers slow to the writer's pace instead of buffering
+        raw HTML without limit.
 
         Args:
             content (str): The HTML content of the page.
             url (str): The URL of the page.
 
         Side Effects:
-            Writes the page content to a file in the storage folder.
+            Awaits `on_page` if set; enqueues the page for the writer task
+            if persisting.
+        """
+        if self.on_page is not None:
+            await self.on_page(content, url)
+        if self.persist:
+            await self._write_q.put((content, url))
+
+    def _flush_batch(self, batch):
         """
-        file_name = f"{uuid.uuid4().hex}.html"
-        file_path = os.path.join(self.storage_folder, file_name)
+        Write a batch of crawled pages to disk and track their metadata.
+
+        Runs in a worker thread via `asyncio.to_thread`, so a batch costs the
+        event loop a single thread-pool hop regardless of its size.
 
-        # Save the content to the file
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(content)
+        Args:
+            batch (list): A list of (content, url) pairs to persist.
+        """
+        for content, url in batch:
+            file_name = f"{next(self._seq):08x}.html.gz"
+            file_path = os.path.join(self.storage_folder, file_name)
+
+            # Compress in memory (HTML shrinks ~5-10x; compresslevel=1 keeps
+            # the CPU cost negligible) and write the file in one syscall,
+            # skipping text-mode encoding and buffered-IO layers entirely
+            data = gzip.compress(content.encode('utf-8'), compresslevel=1)
+            fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+            # Track the crawled page metadata, up to the cap
+            if len(self.crawled_pages) < _MAX_TRACKED_PAGES:
+                self.crawled_pages.append({
+                    "url": url,
+                    "local_filepath": file_path,
+                    "size": len(content)
+                })
+            elif not self._pages_cap_warned:
+                self._pages_cap_warned = True
+                print(f"Crawled-page metadata capped at {_MAX_TRACKED_PAGES} entries")
+
+    async def _writer(self):
+        """
+        Drain the write queue in batches until cancelled.
 
-        # Track the crawled page metadata
-        self.crawled_pages.append({
-            "url": url,
-            "local_filepath": file_path,
-            "size": len(content)
-        })
+        Pulls one pending page, opportunistically grabs whatever else is
+        queued, and flushes the whole batch in one thread-pool hop. IO
+        failures are logged per batch rather than allowed to kill the task:
+        the crawl joins this queue at shutdown, so the drain loop must keep
+        running no matter what the disk does.
+        """
+        while True:
+            batch = [await self._write_q.get()]
+            while not self._write_q.empty():
+                batch.append(self._write_q.get_nowait())
+            try:
+                await asyncio.to_thread(self._flush_batch, batch)
+            except Exception as e:
+                print(f"Failed to save {len(batch)} crawled page(s): {e}")
+            finally:
+                for _ in batch:
+                    self._write_q.task_done()
 
     async def crawl(self):
         """
-        Start the crawling process using Playwright to render and extract web page content.
+        Start the crawling process, rendering pages with Playwright only when needed.
 
-        This function uses an asynchronous workflow to launch a headless Chromium browser,
-        visit URLs, extract content, and follow links recursively.
+        This function drives a pool of concurrent workers over a shared browser context
+        to visit URLs, extract content, and follow links recursively. Static pages are
+        fetched over plain HTTP; JavaScript-heavy ones are rendered in the browser. If a shared
+        `context` or `browser` was injected, it is reused (so one browser can be pooled
+        across tenants); otherwise a headless Chromium is launched for this crawl.
 
         Side Effects:
             Saves crawled pages to the local storage folder.
         """
-        async with async_playwright() as p:
-            # Launch a headless browser
-            browser = await p.chromium.launch(headless=True)
-            context = await browser.new_context()
-
-            # Initialize the queue with starter URLs and their depth
-            queue = [(self.normalize_url(url), 0) for url in self.starter_urls]
+        if self.context is not None:
+            # Caller owns the context; leave it open.
+            await self._crawl_with_context(self.context)
+        elif self.browser is not None:
+            context = await self.browser.new_context(bypass_csp=True)
+            await context.route("**/*", _block_heavy_resources)
+            try:
+                await self._crawl_with_context(context)
+            finally:
+                await context.close()
+        else:
+            async with async_playwright() as p:
+                # Launch a headless browser
+                browser = await p.chromium.launch(headless=True)
+                context = await browser.new_context(bypass_csp=True)
+                await context.route("**/*", _block_heavy_resources)
+                try:
+                    await self._crawl_with_context(context)
+                finally:
+                    await browser.close()
 
-            while queue:
-                # Dequeue the next URL and its depth
-                current_url, depth = queue.pop(0)
-                normalized_url = self.normalize_url(current_url)
+    async def crawl_iter(self, buffer_size=64):
+        """
+        Crawl and yield (content, url) pairs as pages arrive.
 
-                # Skip already visited URLs or those exceeding the hop limit
-                if normalized_url in self.visited_urls or depth > self.hops:
-                    continue
+        Pages flow through a bounded buffer, so memory stays capped no matter
+        how large the site is: when the consumer falls behind, the crawl
+        workers block on the buffer instead of piling pages up. This lets
+        indexing overlap with crawling.
 
-                print(f"Crawling: {current_url}")
-                try:
-                    # Open a new browser page and navigate to the URL
-                    page = await context.new_page()
-                    response = await page.goto(current_url, timeout=10000)
+        Args:
+            buffer_size (int): Maximum number of pages buffered ahead of the consumer.
 
-                    # Skip if the response status indicates an error
-                    if response.status < 200 or response.status >= 400:
-                        print(f"Failed to crawl {current_url}: {response.status}")
-                        continue
+        Yields:
+            tuple: The (content, url) of each crawled page, in crawl order.
+        """
+        buffer = asyncio.Queue(maxsize=buffer_size)
+        previous_on_page = self.on_page
+
+        async def on_page(content, url):
+            if previous_on_page is not None:
+                await previous_on_page(content, url)
+            await buffer.put((content, url))
+
+        async def run():
+            try:
+                await self.crawl()
+            finally:
+                await buffer.put(None)
+
+        self.on_page = on_page
+        crawl_task = asyncio.create_task(run())
+        try:
+            while True:
+                item = await buffer.get()
+                if item is None:
+                    break
+                yield item
+            # Surface any crawl failure to the consumer
+            await crawl_task
+        finally:
+            self.on_page = previous_on_page
+            if not crawl_task.done():
+                crawl_task.cancel()
+                await asyncio.gather(crawl_task, return_exceptions=True)
+
+    async def _crawl_with_context(self, context):
+        """
+        Run the crawl worker pool against the given browser context.
 
-                    self.visited_urls.add(normalized_url)
+        Args:
+            context: The Playwright browser context to open pages in.
+        """
+        # Initialize the queue with starter URLs and their depth
+        queue = asyncio.Queue()
+        for url in self.starter_urls:
+            await self._enqueue_if_new(queue, self.normalize_url(url), 0)
+
+        # Start the background writer (if persisting) and the workers that
+        # pull URLs concurrently; static pages go through a shared HTTP client
+        writer_task = None
+        workers = []
+        self._http_client = httpx.AsyncClient(follow_redirects=True, timeout=10)
+        try:
+            if self.persist:
+                self._write_q = asyncio.Queue(maxsize=_WRITE_QUEUE_MAXSIZE)
+                writer_task = asyncio.create_task(self._writer())
+            workers = [
+                asyncio.create_task(self._worker(context, queue))
+                for _ in range(self.concurrency)
+            ]
+
+            # Wait until every enqueued URL has been processed — but race the
+            # join against the workers themselves, so a pool that dies before
+            # the frontier drains surfaces as an error instead of a hang
+            join_task = asyncio.create_task(queue.join())
+            try:
+                done, _ = await asyncio.wait(
+                    {join_task, *workers}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if join_task not in done:
+                    # A worker exited early; re-raise whatever killed it
+                    for task in done:
+                        task.result()
+                    raise RuntimeError("Crawl worker exited before the frontier drained")
+            finally:
+                join_task.cancel()
+                await asyncio.gather(join_task, return_exceptions=True)
+
+            # Flush any pages still waiting on disk IO before finishing
+            if writer_task is not None:
+                await self._write_q.join()
+        finally:
+            # Retire the workers and writer on every exit path, including
+            # cancellation (e.g. a crawl_iter consumer closing early)
+            tasks = list(workers)
+            if writer_task is not None:
+                tasks.append(writer_task)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._http_client.aclose()
+
+    async def _enqueue_if_new(self, queue, normalized_url, depth):
+        """
+        Atomically reserve a URL in the visited set and enqueue it.
 
-                    # Save the content of the visited page
-                    content = await page.content()
-                    self.save_page_content(content, current_url)
+        Marking URLs visited at enqueue time (rather than after a successful
+        fetch) means concurrent workers discovering the same URL cannot both
+        schedule it: each URL is fetched at most once.
 
-                    # Extract and process links
-                    links = await page.locator("a[href]").element_handles()
-                    for link in links:
-                        href = await link.get_attribute("href")
-                        if href:
-                            normalized_href = self.normalize_url(urljoin(current_url, href))
+        Args:
+            queue (asyncio.Queue): The frontier to enqueue on.
+            normalized_url (str): The normalized URL to schedule.
+            depth (int): The number of hops taken to reach this URL.
+        """
+        if depth > self.hops:
+            return
+        async with self._visited_lock:
+            if normalized_url in self.visited_urls:
+                return
+            self.visited_urls.add(normalized_url)
+        queue.put_nowait((normalized_url, depth))
+
+    async def _backoff_and_requeue(self, queue, current_url, depth, status):
+        """
+        Re-enqueue a throttled URL after exponential backoff.
 
-                            # Add new links to the queue if they are allowed and not visited
-                            if self.is_allowed(normalized_href) and normalized_href not in self.visited_urls:
-                                queue.append((normalized_href, depth + 1))
+        Args:
+            queue (asyncio.Queue): The frontier to re-enqueue on.
+            current_url (str): The URL the server throttled.
+            depth (int): The number of hops taken to reach this URL.
+            status (int): The throttling HTTP status that was returned.
+        """
+        retries = self._retry_counts.get(current_url, 0)
+        if retries >= _MAX_RETRIES:
+            print(f"Failed to crawl {current_url}: {status} (gave up after {retries} retries)")
+            return
+        self._retry_counts[current_url] = retries + 1
+        await asyncio.sleep(_BACKOFF_BASE * (2 ** retries))
+        # The URL is already reserved in visited_urls, so re-enqueue directly
+        queue.put_nowait((current_url, depth))
+
+    async def _worker(self, context, queue):
+        """
+        Process URLs from the queue until cancelled.
 
-                    await page.close()
+        Each worker opens a single page at startup and navigates it from URL
+        to URL, since constructing and tearing down a page per URL is one of
+        the more expensive Playwright operations.
 
+        Args:
+            context: The Playwright browser context to open pages in.
+            queue (asyncio.Queue): The frontier of (url, depth) pairs to crawl.
+        """
+        page = await context.new_page()
+        try:
+            while True:
+                current_url, depth = await queue.get()
+                try:
+                    await self._crawl_page(page, queue, current_url, depth)
                 except Exception as e:
                     print(f"Failed to crawl {current_url}: {e}")
+                    # A crashed/closed page poisons every later goto on it,
+                    # which would blackhole this worker's share of the crawl;
+                    # replace it so the failure costs one URL, not 1/N of them
+                    try:
+                        await page.close()
+                    except Exception:
+                        pass
+                    page = await context.new_page()
+                finally:
+                    queue.task_done()
+        finally:
+            try:
+                await page.close()
+            except Exception:
+                pass
+
+    async def _fetch(self, page, url):
+        """
+        Fetch a URL, preferring a plain HTTP GET over browser rendering.
+
+        Most pages are static HTML for which a browser render is pure
+        overhead; only when the response is not HTML or looks
+        JavaScript-heavy (many script tags) does the worker fall back to
+        navigating its Playwright page.
 
-            # Close the browser
-            await browser.close()
\ No newline at end of file
+        Args:
+            page: The worker's Playwright page, used only for the fallback.
+            url (str): The URL to fetch.
+
+        Returns:
+            tuple: (status, content, hrefs) where content is None on failure
+            and hrefs are absolute URLs extracted from the page.
+        """
+        try:
+            response = await self._http_client.get(url)
+        except httpx.HTTPError:
+            response = None
+
+        if response is not None:
+            # Throttling is final either way: report it so the caller backs off
+            if response.status_code in _THROTTLE_STATUSES:
+                return response.status_code, None, []
+            if response.status_code < 400:
+                content_type = response.headers.get("content-type", "")
+                if "html" in content_type:
+                    body = response.text
+                    if body.count("<script") < _MAX_STATIC_SCRIPT_TAGS:
+                        try:
+                            # Parse the raw bytes: lxml rejects decoded str
+                            # input that carries an XML encoding declaration
+                            root = lxml.html.fromstring(response.content)
+                        except Exception:
+                            # Unparseable fast-path body; let the browser try
+                            root = None
+                        if root is not None:
+                            base_url = str(response.url)
+                            hrefs = [
+                                urljoin(base_url, href)
+                                for href in root.xpath("//a/@href")
+                            ]
+                            return response.status_code, body, hrefs
+
+        # JS-heavy page, an error status (bot detection routinely 403s the
+        # plain-HTTP user agent yet serves the browser), or a failed GET:
+        # render it, and let the browser's status be the authoritative one
+        browser_response = await page.goto(url, wait_until="domcontentloaded", timeout=10000)
+        if browser_response.status < 200 or browser_response.status >= 400:
+            return browser_response.status, None, []
+        content = await page.content()
+        # Extract all links in one round trip; e.href is already absolute
+        hrefs = await page.eval_on_selector_all("a[href]", "els => els.map(e => e.href)")
+        return browser_response.status, content, hrefs
+
+    async def _crawl_page(self, page, queue, current_url, depth):
+        """
+        Crawl a single URL: fetch it, save its content, and enqueue its links.
+
+        Args:
+            page: The worker's Playwright page to navigate on fallback.
+            queue (asyncio.Queue): The frontier to enqueue discovered links on.
+            current_url (str): The URL to crawl.
+            depth (int): The number of hops taken to reach this URL.
+        """
+        print(f"Crawling: {current_url}")
+        host = self._normalize_url_cached(current_url)[1]
+        async with self._host_slots[host]:
+            # Space fetches against the same host at least the minimum
+            # interval apart so the worker pool cannot slam a single server
+            now = time.monotonic()
+            wait = self._host_next_fetch[host] - now
+            self._host_next_fetch[host] = max(now, self._host_next_fetch[host]) + _PER_HOST_MIN_INTERVAL
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            status, content, hrefs = await self._fetch(page, current_url)
+
+        # Back off and retry when the server signals throttling
+        if status in _THROTTLE_STATUSES:
+            await self._backoff_and_requeue(queue, current_url, depth, status)
+            return
+
+        # Skip if the fetch failed or the status indicates an error
+        if content is None or status < 200 or status >= 400:
+            print(f"Failed to crawl {current_url}: {status}")
+            return
+
+        # Save the content of the visited page
+        await self.save_page_content(content, current_url)
+
+        for href in hrefs:
+            if href:
+                normalized_href = self.normalize_url(href)
+
+                # Schedule new links if they are allowed and not yet reserved
+                if self.is_allowed(normalized_href):
+                    await self._enqueue_if_new(queue, normalized_href, depth + 1)
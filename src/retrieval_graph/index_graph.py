@@ -1,7 +1,11 @@
 """This "graph" simply exposes an endpoint for a user to upload docs to be indexed."""
-import json
+import asyncio
+import functools
+import gzip
 
-from typing import Optional, Sequence
+from typing import AsyncIterator, Optional, Sequence
+
+import orjson
 
 from langchain_community.utilities import ApifyWrapper
 from langchain_community.document_loaders import ApifyDatasetLoader
@@ -16,6 +20,11 @@ from retrieval_graph.crawler import WebCrawler
 from retrieval_graph.configuration import IndexConfiguration
 from retrieval_graph.state import IndexState
 
+# Indexing batch shape: docs per retriever call, and how many of those
+# calls may be in flight at once against the embedding API.
+INDEX_BATCH_SIZE = 128
+INDEX_CONCURRENCY = 8
+
 
 def ensure_docs_have_user_id(
     docs: Sequence[Document], config: RunnableConfig
@@ -26,32 +35,43 @@ def ensure_docs_have_user_id(
         config (RunnableConfig): A configuration object containing the user_id.
 
     Returns:
-        list[Document]: A new list of Document objects with updated metadata.
+        list[Document]: The documents with updated metadata.
     """
     user_id = config["configurable"]["user_id"]
-    return [
-        Document(
-            page_content=doc.page_content, metadata={**doc.metadata, "user_id": user_id}
-        )
-        for doc in docs
-    ]
+    # Stamp metadata in place; rebuilding every Document (and metadata dict)
+    # just to add one key doubles allocations on large crawls
+    for doc in docs:
+        doc.metadata["user_id"] = user_id
+    return list(docs)
 
 def get_file_content(file_path: str) -> str:
+    if file_path.endswith(".gz"):
+        with gzip.open(file_path, 'rt', encoding='utf-8') as file:
+            return file.read()
     with open(file_path, 'r', encoding='utf-8') as file:
         return file.read()
     
+@functools.cache
 def load_site_dataset_map() -> dict:
-    with open("sites_dataset_map.json", 'r', encoding='utf-8') as file:
-        return json.load(file)
+    with open("sites_dataset_map.json", 'rb') as file:
+        return orjson.loads(file.read())
     
-async def crawl(tenant: str, starter_urls: list, hops: int):
+async def crawl(tenant: str, starter_urls: list, hops: int) -> AsyncIterator[list[Document]]:
+    """Crawl the starter URLs, yielding Documents in bounded batches.
+
+    Batches stream out while the crawl is still running, so indexing can
+    overlap with crawling and memory stays bounded regardless of site size.
+    """
     allowed_domains = set(urlparse(url).netloc for url in starter_urls)
-    crawler = WebCrawler(starter_urls, hops, allowed_domains, tenant)
-    await crawler.crawl()
-    return [
-        Document(page_content=get_file_content(page["local_filepath"]), metadata={"url": page["url"]})
-        for page in crawler.crawled_pages
-    ]
+    crawler = WebCrawler(starter_urls, hops, allowed_domains, tenant, persist=False)
+    batch: list[Document] = []
+    async for content, url in crawler.crawl_iter():
+        batch.append(Document(page_content=content, metadata={"url": url}))
+        if len(batch) >= INDEX_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def apify_crawl(tenant: str, starter_urls: list, hops: int):
     site_dataset_map = load_site_dataset_map()
@@ -99,21 +119,31 @@ async def index_docs(
         configuration = IndexConfiguration.from_runnable_config(config)
         if not state.docs and configuration.starter_urls:
             print(f"starting crawl ...")
-            # state.docs = await crawl (
-            #     configuration.user_id,
-            #     configuration.parse_starter_urls(),
-            #     configuration.hops
-            # )
+            starter_urls = configuration.parse_starter_urls()
+            # async for batch in crawl(configuration.user_id, starter_urls, configuration.hops):
+            #     await retriever.aadd_documents(ensure_docs_have_user_id(batch, config))
             state.docs = apify_crawl (
                 configuration.user_id,
-                [{"url": url} for url in configuration.parse_starter_urls()],
+                [{"url": url} for url in starter_urls],
                 configuration.hops
             )
         stamped_docs = ensure_docs_have_user_id(state.docs, config)
+        batches = [
+            stamped_docs[i : i + INDEX_BATCH_SIZE]
+            for i in range(0, len(stamped_docs), INDEX_BATCH_SIZE)
+        ]
         if configuration.retriever_provider == "milvus":
-            retriever.add_documents(stamped_docs)
+            for batch in batches:
+                retriever.add_documents(batch)
         else:
-            await retriever.aadd_documents(stamped_docs)
+            # Overlap embedding-API latency across a bounded number of batches
+            sem = asyncio.Semaphore(INDEX_CONCURRENCY)
+
+            async def _add(batch: list[Document]) -> None:
+                async with sem:
+                    await retriever.aadd_documents(batch)
+
+            await asyncio.gather(*(_add(batch) for batch in batches))
     return {"docs": "delete"}
 
 